@@ -1,23 +1,45 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, Field
-from typing import Dict, List, Optional, Any
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import BaseModel, Field, field_validator
+from typing import Dict, Iterable, List, Optional, Set, Any
 import asyncio
-import json
-import subprocess
+import contextlib
+import orjson
 import os
+import re
+import time
 import psutil
 import uuid
+from collections import deque
+import yaml
 from datetime import datetime
-import redis
+from redis import asyncio as aioredis
+from redis.exceptions import WatchError
+from arq import create_pool
+from arq.connections import ArqRedis, RedisSettings
+from arq.constants import abort_jobs_ss
+from arq.utils import timestamp_ms
 import logging
 from enum import Enum
 
+# Prefer the libyaml C dumper for training configs when it is available
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+
+# NVIDIA GPU metrics are optional and read through NVML when pynvml is installed
+try:
+    import pynvml
+except ImportError:
+    pynvml = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="Felafax Service API", version="1.0.0")
+app = FastAPI(title="Felafax Service API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Add CORS middleware
 app.add_middleware(
@@ -28,8 +50,20 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Redis connection for job storage
-redis_client = redis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+# Redis connection pool for job storage, shared by all concurrent requests; when
+# every connection is busy, callers wait up to 5 seconds instead of failing
+redis_pool = aioredis.BlockingConnectionPool(
+    host='localhost', port=6379, db=0, decode_responses=True, max_connections=64, timeout=5
+)
+redis_client = aioredis.Redis(connection_pool=redis_pool)
+
+# Pub/Sub relays hold a connection for as long as a job has watchers, so they get
+# their own client and can't starve request traffic of pooled connections
+pubsub_client = aioredis.Redis(host='localhost', port=6379, db=0, decode_responses=True)
+
+# arq task queue; training runs in separate worker processes (see WorkerSettings)
+arq_redis_settings = RedisSettings(host='localhost', port=6379, database=0)
+arq_pool: Optional[ArqRedis] = None
 
 class HardwareType(str, Enum):
     TPU = "tpu"
@@ -48,6 +82,16 @@ class FineTuningRequest(BaseModel):
     hardware: HardwareType = Field(default=HardwareType.TPU, description="Hardware type")
     precision: ModelPrecision = Field(default=ModelPrecision.BFLOAT16, description="Model precision")
     user_id: Optional[str] = Field(None, description="User ID for tracking")
+    
+    @field_validator('config')
+    @classmethod
+    def config_must_be_storable(cls, config: Dict[str, Any]) -> Dict[str, Any]:
+        """Reject configs orjson can't store, e.g. integers wider than 64 bits"""
+        try:
+            orjson.dumps(config)
+        except orjson.JSONEncodeError as e:
+            raise ValueError(f"config cannot be serialized: {str(e)}")
+        return config
 
 class TrainingJob(BaseModel):
     job_id: str
@@ -78,31 +122,61 @@ class CostEstimate(BaseModel):
     hardware_type: HardwareType
     cost_per_hour: float
 
+# WebSocket broadcasts are sent to subscribers BROADCAST_BATCH_SIZE at a time, at
+# most once per BROADCAST_INTERVAL seconds per job (bursts collapse to the latest)
+BROADCAST_BATCH_SIZE = 50
+BROADCAST_INTERVAL = 0.1
+
+# Published on job:{id}:updates after every write; subscribers re-read the job
+JOB_UPDATED = "updated"
+
+# A relay that loses its Pub/Sub connection resubscribes, backing off from
+# RELAY_RETRY_DELAY up to RELAY_RETRY_MAX_DELAY seconds between attempts
+RELAY_RETRY_DELAY = 1
+RELAY_RETRY_MAX_DELAY = 30
+
 # Connection manager for WebSocket
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, List[WebSocket]] = {}
+        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        self.relays: Dict[str, asyncio.Task] = {}
 
     async def connect(self, websocket: WebSocket, job_id: str):
         await websocket.accept()
         if job_id not in self.active_connections:
-            self.active_connections[job_id] = []
-        self.active_connections[job_id].append(websocket)
+            self.active_connections[job_id] = set()
+        self.active_connections[job_id].add(websocket)
+        
+        # A single Pub/Sub relay per job feeds every subscriber
+        if job_id not in self.relays:
+            self.relays[job_id] = asyncio.create_task(relay_job_updates(job_id))
 
     def disconnect(self, websocket: WebSocket, job_id: str):
         if job_id in self.active_connections:
-            self.active_connections[job_id].remove(websocket)
+            self.active_connections[job_id].discard(websocket)
             if not self.active_connections[job_id]:
                 del self.active_connections[job_id]
+                relay = self.relays.pop(job_id, None)
+                if relay:
+                    relay.cancel()
 
     async def send_message(self, message: str, job_id: str):
-        if job_id in self.active_connections:
-            for connection in self.active_connections[job_id]:
-                try:
-                    await connection.send_text(message)
-                except:
+        # Snapshot so connects/disconnects during the sends can't mutate what we iterate
+        connections = list(self.active_connections.get(job_id, ()))
+        for start in range(0, len(connections), BROADCAST_BATCH_SIZE):
+            batch = connections[start:start + BROADCAST_BATCH_SIZE]
+            results = await asyncio.gather(
+                *(connection.send_text(message) for connection in batch),
+                return_exceptions=True
+            )
+            for connection, result in zip(batch, results):
+                if isinstance(result, Exception):
                     # Connection might be closed, remove it
-                    self.active_connections[job_id].remove(connection)
+                    self.disconnect(connection, job_id)
+            
+            # Yield to the event loop between batches on large fan-outs
+            if start + BROADCAST_BATCH_SIZE < len(connections):
+                await asyncio.sleep(0)
 
 manager = ConnectionManager()
 
@@ -114,6 +188,169 @@ HARDWARE_COSTS = {
     HardwareType.AMD: 0.80,  # $0.80 per hour per AMD GPU
 }
 
+# Models available for fine-tuning, served pre-serialized by /felafax/models
+AVAILABLE_MODELS = [
+    {
+        "name": "llama3-2-1b",
+        "description": "LLaMA 3.2 1B parameters",
+        "hardware": ["tpu", "trainium", "gpu", "amd"],
+        "precision": ["bfloat16", "float32"]
+    },
+    {
+        "name": "llama3-2-3b",
+        "description": "LLaMA 3.2 3B parameters",
+        "hardware": ["tpu", "trainium", "gpu", "amd"],
+        "precision": ["bfloat16", "float32"]
+    },
+    {
+        "name": "llama3-1-8b",
+        "description": "LLaMA 3.1 8B parameters",
+        "hardware": ["tpu", "trainium", "gpu"],
+        "precision": ["bfloat16", "float32"]
+    },
+    {
+        "name": "llama3-1-70b",
+        "description": "LLaMA 3.1 70B parameters",
+        "hardware": ["tpu", "trainium"],
+        "precision": ["bfloat16"]
+    },
+    {
+        "name": "llama3-1-405b",
+        "description": "LLaMA 3.1 405B parameters",
+        "hardware": ["tpu", "amd"],
+        "precision": ["bfloat16"]
+    }
+]
+AVAILABLE_MODELS_RESPONSE = orjson.dumps({"models": AVAILABLE_MODELS})
+
+# (model, hardware) pairs accepted by /felafax/tune and /felafax/cost-estimate
+SUPPORTED_MODEL_HARDWARE = frozenset(
+    (model["name"], hardware) for model in AVAILABLE_MODELS for hardware in model["hardware"]
+)
+
+# Relative training duration per model, used for cost estimates
+MODEL_SIZE_FACTORS = {
+    'llama3-2-1b': 1.0,
+    'llama3-2-3b': 2.5,
+    'llama3-1-8b': 6.0,
+    'llama3-1-70b': 50.0,
+    'llama3-1-405b': 300.0
+}
+
+# Hardware metrics are sampled in the background every HARDWARE_SAMPLE_INTERVAL
+# seconds and served from latest_hardware_metrics
+HARDWARE_SAMPLE_INTERVAL = 2
+latest_hardware_metrics: Optional[HardwareMetrics] = None
+hardware_sampler: Optional[asyncio.Task] = None
+nvml_available = False
+
+# Training log buffering: keep the last LOG_TAIL lines per job in Redis and
+# flush buffered lines every LOG_FLUSH_LINES lines or LOG_FLUSH_INTERVAL seconds
+LOG_TAIL = 100
+LOG_FLUSH_LINES = 25
+LOG_FLUSH_INTERVAL = 0.5
+
+# Seconds to wait for a trainer to exit after SIGTERM before killing it
+TRAINER_TERMINATE_TIMEOUT = 10
+
+# Matches the step counter in raw trainer output lines, e.g. b"Step 120 | loss 0.53"
+STEP_RE = re.compile(rb'step\s*(\d+)', re.IGNORECASE)
+
+# Trainer output is read TRAINER_READ_SIZE bytes at a time and split on both \n and
+# the \r that progress bars redraw with; longer lines are cut at TRAINER_LINE_LIMIT
+TRAINER_READ_SIZE = 64 * 1024
+TRAINER_LINE_LIMIT = 1024 * 1024
+LINE_SPLIT_RE = re.compile(rb'[\r\n]')
+
+def job_to_fields(job: TrainingJob) -> Dict[str, Any]:
+    """Flatten a TrainingJob into Redis hash fields; logs are stored separately"""
+    return {
+        'job_id': job.job_id,
+        'model': job.model,
+        'dataset': job.dataset,
+        'status': job.status,
+        'progress': job.progress,
+        'hardware': job.hardware.value,
+        'precision': job.precision.value,
+        # Timestamps are stored as Unix epoch seconds
+        'created_at': job.created_at.timestamp(),
+        'updated_at': job.updated_at.timestamp(),
+        # Written once at creation, so a single JSON-encoded field is enough
+        'config': orjson.dumps(job.config),
+        'metrics': orjson.dumps(job.metrics),
+    }
+
+def decode_job_fields(job_fields: Dict[str, str], logs: List[str]) -> Dict[str, Any]:
+    """Turn stored hash fields and the log tail back into a job dict"""
+    job_dict = dict(job_fields)
+    job_dict['progress'] = float(job_dict['progress'])
+    job_dict['created_at'] = datetime.fromtimestamp(float(job_dict['created_at']))
+    job_dict['updated_at'] = datetime.fromtimestamp(float(job_dict['updated_at']))
+    job_dict['config'] = orjson.loads(job_dict['config'])
+    job_dict['metrics'] = orjson.loads(job_dict['metrics'])
+    job_dict['logs'] = logs
+    return job_dict
+
+def parse_job(job_fields: Dict[str, str], logs: List[str]) -> TrainingJob:
+    """Build a TrainingJob from its stored hash fields and log tail"""
+    return TrainingJob(**decode_job_fields(job_fields, logs))
+
+async def migrate_legacy_jobs():
+    """Convert job records stored as JSON strings by earlier versions into hashes"""
+    migrated = 0
+    async for key in redis_client.scan_iter(match="job:*", count=500, _type="string"):
+        try:
+            job_data = await redis_client.get(key)
+            if job_data is None:
+                continue
+            job = TrainingJob(**orjson.loads(job_data))
+            
+            # Swap the string for a hash and log list atomically, keeping the same tail
+            pipe = redis_client.pipeline(transaction=True)
+            pipe.delete(key)
+            pipe.hset(key, mapping=job_to_fields(job))
+            if job.logs:
+                pipe.rpush(f"{key}:logs", *job.logs[-LOG_TAIL:])
+            if job.config.get('user_id'):
+                pipe.sadd(f"user:{job.config['user_id']}:jobs", job.job_id)
+            await pipe.execute()
+            migrated += 1
+        except Exception as e:
+            logger.error(f"Error migrating legacy job record {key}: {str(e)}")
+    
+    if migrated:
+        logger.info(f"Migrated {migrated} legacy job records")
+
+def validate_model_hardware(request: FineTuningRequest):
+    """Reject models that are unknown or not supported on the requested hardware"""
+    if (request.model, request.hardware.value) not in SUPPORTED_MODEL_HARDWARE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Model {request.model} is not supported on {request.hardware.value}"
+        )
+
+@app.on_event("startup")
+async def startup():
+    global arq_pool, hardware_sampler
+    arq_pool = await create_pool(arq_redis_settings)
+    await migrate_legacy_jobs()
+    hardware_sampler = asyncio.create_task(sample_hardware_loop())
+    
+    # Let coroutines that finish without suspending (e.g. cache hits) skip a
+    # scheduler round-trip; eager_task_factory is only available on 3.12+
+    if hasattr(asyncio, "eager_task_factory"):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
+@app.on_event("shutdown")
+async def shutdown():
+    hardware_sampler.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await hardware_sampler
+    await arq_pool.aclose()
+    await redis_client.aclose()
+    await redis_pool.disconnect()
+    await pubsub_client.aclose()
+
 @app.get("/")
 async def root():
     return {"message": "Felafax Service API", "version": "1.0.0"}
@@ -123,9 +360,11 @@ async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
 @app.post("/felafax/tune", response_model=Dict[str, str])
-async def start_fine_tuning(request: FineTuningRequest, background_tasks: BackgroundTasks):
+async def start_fine_tuning(request: FineTuningRequest):
     """Start a fine-tuning job using Felafax"""
     try:
+        validate_model_hardware(request)
+        
         job_id = f"job_{uuid.uuid4().hex[:8]}"
         
         # Create job record
@@ -142,11 +381,20 @@ async def start_fine_tuning(request: FineTuningRequest, background_tasks: Backgr
             config=request.config
         )
         
-        # Store job in Redis
-        redis_client.set(f"job:{job_id}", json.dumps(job.dict(), default=str))
+        # Store, index and announce the job in a single round-trip
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(f"job:{job_id}", mapping=job_to_fields(job))
+        
+        # Index the job under its owner so list_jobs can skip a keyspace scan
+        owner_id = request.user_id or request.config.get('user_id')
+        if owner_id:
+            pipe.sadd(f"user:{owner_id}:jobs", job_id)
         
-        # Start background task
-        background_tasks.add_task(run_felafax_training, job_id, request)
+        pipe.publish(f"job:{job_id}:updates", JOB_UPDATED)
+        await pipe.execute()
+        
+        # Queue the training run for a worker, keyed by our job id so it can be aborted
+        await arq_pool.enqueue_job('run_felafax_training_task', job_id, request.model_dump(), _job_id=job_id)
         
         logger.info(f"Started fine-tuning job {job_id} for model {request.model}")
         
@@ -156,6 +404,8 @@ async def start_fine_tuning(request: FineTuningRequest, background_tasks: Backgr
             "message": "Fine-tuning job initiated successfully"
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error starting fine-tuning job: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -164,15 +414,14 @@ async def start_fine_tuning(request: FineTuningRequest, background_tasks: Backgr
 async def get_job_status(job_id: str):
     """Get the status of a specific training job"""
     try:
-        job_data = redis_client.get(f"job:{job_id}")
-        if not job_data:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hgetall(f"job:{job_id}")
+        pipe.lrange(f"job:{job_id}:logs", 0, -1)
+        job_fields, logs = await pipe.execute()
+        if not job_fields:
             raise HTTPException(status_code=404, detail="Job not found")
         
-        job_dict = json.loads(job_data)
-        job_dict['created_at'] = datetime.fromisoformat(job_dict['created_at'])
-        job_dict['updated_at'] = datetime.fromisoformat(job_dict['updated_at'])
-        
-        return TrainingJob(**job_dict)
+        return parse_job(job_fields, logs)
         
     except HTTPException:
         raise
@@ -185,20 +434,35 @@ async def list_jobs(user_id: Optional[str] = None, limit: int = 50):
     """List all training jobs, optionally filtered by user"""
     try:
         jobs = []
-        job_keys = redis_client.keys("job:*")
-        
-        for key in job_keys[:limit]:
-            job_data = redis_client.get(key)
-            if job_data:
-                job_dict = json.loads(job_data)
-                job_dict['created_at'] = datetime.fromisoformat(job_dict['created_at'])
-                job_dict['updated_at'] = datetime.fromisoformat(job_dict['updated_at'])
-                
-                job = TrainingJob(**job_dict)
-                
-                # Filter by user_id if provided
-                if user_id is None or job.config.get('user_id') == user_id:
-                    jobs.append(job)
+        if limit <= 0:
+            return jobs
+        
+        if user_id is not None:
+            # Only fetch the user's own jobs via the secondary index
+            job_ids = sorted(await redis_client.smembers(f"user:{user_id}:jobs"))
+            job_keys = [f"job:{jid}" for jid in job_ids[:limit]]
+        else:
+            # SCAN instead of KEYS so Redis is not blocked on large keyspaces
+            job_keys = []
+            # Restricting to hashes skips the job:{id}:logs lists
+            async for key in redis_client.scan_iter(match="job:*", count=500, _type="hash"):
+                job_keys.append(key)
+                if len(job_keys) >= limit:
+                    break
+        
+        if not job_keys:
+            return jobs
+        
+        # Fetch all jobs and their logs in a single round-trip
+        pipe = redis_client.pipeline(transaction=False)
+        for key in job_keys:
+            pipe.hgetall(key)
+            pipe.lrange(f"{key}:logs", 0, -1)
+        results = await pipe.execute()
+        
+        for job_fields, logs in zip(results[::2], results[1::2]):
+            if job_fields:
+                jobs.append(parse_job(job_fields, logs))
         
         return jobs
         
@@ -210,18 +474,17 @@ async def list_jobs(user_id: Optional[str] = None, limit: int = 50):
 async def cancel_job(job_id: str):
     """Cancel a running training job"""
     try:
-        job_data = redis_client.get(f"job:{job_id}")
-        if not job_data:
+        if not await redis_client.exists(f"job:{job_id}"):
             raise HTTPException(status_code=404, detail="Job not found")
         
-        job_dict = json.loads(job_data)
-        job_dict['status'] = "cancelled"
-        job_dict['updated_at'] = datetime.now().isoformat()
-        
-        redis_client.set(f"job:{job_id}", json.dumps(job_dict))
+        await update_job(job_id, {
+            'status': "cancelled",
+            'updated_at': time.time()
+        })
         
-        # Here you would implement actual process termination
-        # For now, just mark as cancelled
+        # Ask the worker to abort the run; it terminates the training process. This
+        # writes arq's abort marker directly, as Job.abort() would wait for the result
+        await arq_pool.zadd(abort_jobs_ss, {job_id: timestamp_ms()})
         
         return {"message": f"Job {job_id} cancelled successfully"}
         
@@ -235,47 +498,71 @@ async def cancel_job(job_id: str):
 async def get_hardware_metrics():
     """Get current hardware utilization metrics"""
     try:
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
-        
-        metrics = HardwareMetrics(
-            cpu_usage=cpu_percent,
-            memory_usage=memory.percent,
-            disk_usage=disk.percent
-        )
-        
-        # Add GPU metrics if available
-        try:
-            import GPUtil
-            gpus = GPUtil.getGPUs()
-            if gpus:
-                metrics.gpu_usage = gpus[0].load * 100
-                metrics.gpu_memory = gpus[0].memoryUtil * 100
-        except ImportError:
-            pass
-        
-        return metrics
+        # Served from the background sampler; only sample inline before its first run
+        return latest_hardware_metrics or await asyncio.to_thread(sample_hardware_metrics)
         
     except Exception as e:
         logger.error(f"Error getting hardware metrics: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+def sample_hardware_metrics() -> HardwareMetrics:
+    """Take a non-blocking snapshot of hardware utilization"""
+    cpu_percent = psutil.cpu_percent(interval=None)
+    memory = psutil.virtual_memory()
+    disk = psutil.disk_usage('/')
+    
+    metrics = HardwareMetrics(
+        cpu_usage=cpu_percent,
+        memory_usage=memory.percent,
+        disk_usage=disk.percent
+    )
+    
+    # Add GPU metrics if available; NVML is a library call, unlike spawning nvidia-smi
+    if nvml_available:
+        handle = pynvml.nvmlDeviceGetHandleByIndex(0)
+        utilization = pynvml.nvmlDeviceGetUtilizationRates(handle)
+        gpu_memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+        metrics.gpu_usage = float(utilization.gpu)
+        metrics.gpu_memory = gpu_memory.used / gpu_memory.total * 100
+    
+    return metrics
+
+def init_nvml() -> bool:
+    """Initialize NVML, returning whether an NVIDIA GPU can be sampled"""
+    if pynvml is None:
+        return False
+    try:
+        pynvml.nvmlInit()
+        return pynvml.nvmlDeviceGetCount() > 0
+    except pynvml.NVMLError:
+        return False
+
+async def sample_hardware_loop():
+    """Refresh latest_hardware_metrics every HARDWARE_SAMPLE_INTERVAL seconds"""
+    global latest_hardware_metrics, nvml_available
+    nvml_available = await asyncio.to_thread(init_nvml)
+    # The first non-blocking cpu_percent call only sets the measurement baseline
+    await asyncio.to_thread(psutil.cpu_percent, None)
+    try:
+        while True:
+            await asyncio.sleep(HARDWARE_SAMPLE_INTERVAL)
+            try:
+                latest_hardware_metrics = await asyncio.to_thread(sample_hardware_metrics)
+            except Exception as e:
+                logger.error(f"Error sampling hardware metrics: {str(e)}")
+    finally:
+        if nvml_available:
+            pynvml.nvmlShutdown()
+
 @app.post("/felafax/cost-estimate", response_model=CostEstimate)
 async def estimate_cost(request: FineTuningRequest):
     """Estimate the cost of a fine-tuning job"""
     try:
+        validate_model_hardware(request)
+        
         # Estimate duration based on model size and dataset
         # This is a simplified calculation - in practice, you'd use more sophisticated estimates
-        model_size_factor = {
-            'llama3-2-1b': 1.0,
-            'llama3-2-3b': 2.5,
-            'llama3-1-8b': 6.0,
-            'llama3-1-70b': 50.0,
-            'llama3-1-405b': 300.0
-        }
-        
-        base_hours = model_size_factor.get(request.model, 1.0)
+        base_hours = MODEL_SIZE_FACTORS.get(request.model, 1.0)
         batch_size = request.config.get('batch_size', 8)
         estimated_hours = base_hours * (8 / batch_size)  # Adjust for batch size
         
@@ -289,6 +576,8 @@ async def estimate_cost(request: FineTuningRequest):
             cost_per_hour=cost_per_hour
         )
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error estimating cost: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -296,71 +585,144 @@ async def estimate_cost(request: FineTuningRequest):
 @app.get("/felafax/models")
 async def list_available_models():
     """List available models for fine-tuning"""
-    return {
-        "models": [
-            {
-                "name": "llama3-2-1b",
-                "description": "LLaMA 3.2 1B parameters",
-                "hardware": ["tpu", "trainium", "gpu", "amd"],
-                "precision": ["bfloat16", "float32"]
-            },
-            {
-                "name": "llama3-2-3b", 
-                "description": "LLaMA 3.2 3B parameters",
-                "hardware": ["tpu", "trainium", "gpu", "amd"],
-                "precision": ["bfloat16", "float32"]
-            },
-            {
-                "name": "llama3-1-8b",
-                "description": "LLaMA 3.1 8B parameters", 
-                "hardware": ["tpu", "trainium", "gpu"],
-                "precision": ["bfloat16", "float32"]
-            },
-            {
-                "name": "llama3-1-70b",
-                "description": "LLaMA 3.1 70B parameters",
-                "hardware": ["tpu", "trainium"],
-                "precision": ["bfloat16"]
-            },
-            {
-                "name": "llama3-1-405b",
-                "description": "LLaMA 3.1 405B parameters",
-                "hardware": ["tpu", "amd"],
-                "precision": ["bfloat16"]
-            }
-        ]
-    }
+    return Response(content=AVAILABLE_MODELS_RESPONSE, media_type="application/json")
 
 @app.websocket("/felafax/ws/{job_id}")
 async def websocket_endpoint(websocket: WebSocket, job_id: str):
     """WebSocket endpoint for real-time job updates"""
     await manager.connect(websocket, job_id)
     try:
+        # Prime the client with the current state; later updates are pushed
+        job_payload = await load_job_payload(job_id)
+        if job_payload:
+            await websocket.send_text(job_payload)
+        
         while True:
-            # Send periodic updates
-            job_data = redis_client.get(f"job:{job_id}")
-            if job_data:
-                await manager.send_message(job_data, job_id)
-            await asyncio.sleep(5)  # Update every 5 seconds
+            await websocket.receive_text()
     except WebSocketDisconnect:
+        pass
+    finally:
+        # Also release the relay on errors such as a Redis failure or a binary frame
         manager.disconnect(websocket, job_id)
 
+async def load_job_payload(job_id: str) -> Optional[str]:
+    """Return the job's stored record with its log tail as a JSON string"""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hgetall(f"job:{job_id}")
+    pipe.lrange(f"job:{job_id}:logs", 0, -1)
+    job_fields, logs = await pipe.execute()
+    if not job_fields:
+        return None
+    
+    return orjson.dumps(decode_job_fields(job_fields, logs)).decode()
+
+async def update_job(job_id: str, job_fields: Dict[str, Any], new_logs: Iterable[str] = ()):
+    """Write changed fields and new log lines, then notify the job's subscribers"""
+    logs_key = f"job:{job_id}:logs"
+    pipe = redis_client.pipeline(transaction=False)
+    if new_logs:
+        pipe.rpush(logs_key, *new_logs)
+        pipe.ltrim(logs_key, -LOG_TAIL, -1)
+    pipe.hset(f"job:{job_id}", mapping=job_fields)
+    # Only a change notification is published; relays with subscribers read the
+    # job state themselves, at most once per BROADCAST_INTERVAL
+    pipe.publish(f"job:{job_id}:updates", JOB_UPDATED)
+    await pipe.execute()
+
+async def update_job_status(job_id: str, job_fields: Dict[str, Any]) -> bool:
+    """Like update_job, but leaves jobs that were cancelled or deleted untouched
+
+    Returns whether the fields were written.
+    """
+    job_key = f"job:{job_id}"
+    async with redis_client.pipeline(transaction=True) as pipe:
+        while True:
+            try:
+                # Abort the write if cancel_job changes the job between our check and MULTI
+                await pipe.watch(job_key)
+                if await pipe.hget(job_key, 'status') in (None, 'cancelled'):
+                    return False
+                
+                pipe.multi()
+                pipe.hset(job_key, mapping=job_fields)
+                pipe.publish(f"job:{job_id}:updates", JOB_UPDATED)
+                await pipe.execute()
+                return True
+            except WatchError:
+                continue
+
+async def relay_job_updates(job_id: str):
+    """Push the job's state to all of its subscribers whenever it is notified of a change"""
+    dirty = asyncio.Event()
+    
+    async def broadcast():
+        # Only the latest state matters to clients, so a burst of notifications
+        # costs a single read per BROADCAST_INTERVAL
+        while True:
+            await dirty.wait()
+            dirty.clear()
+            try:
+                job_payload = await load_job_payload(job_id)
+                if job_payload:
+                    await manager.send_message(job_payload, job_id)
+            except Exception as e:
+                logger.error(f"Error broadcasting update for job {job_id}: {str(e)}")
+            await asyncio.sleep(BROADCAST_INTERVAL)
+    
+    broadcaster = asyncio.create_task(broadcast())
+    retry_delay = RELAY_RETRY_DELAY
+    resubscribing = False
+    try:
+        # Runs until the last subscriber leaves and ConnectionManager cancels us
+        while True:
+            pubsub = pubsub_client.pubsub()
+            try:
+                await pubsub.subscribe(f"job:{job_id}:updates")
+                if resubscribing:
+                    # Notifications published while we were disconnected are lost, so resync
+                    dirty.set()
+                retry_delay = RELAY_RETRY_DELAY
+                
+                async for message in pubsub.listen():
+                    if message['type'] == 'message':
+                        dirty.set()
+            except Exception as e:
+                logger.error(f"Error relaying updates for job {job_id}, retrying in {retry_delay}s: {str(e)}")
+            finally:
+                await pubsub.aclose()
+            
+            await asyncio.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, RELAY_RETRY_MAX_DELAY)
+            resubscribing = True
+    finally:
+        broadcaster.cancel()
+        if manager.relays.get(job_id) is asyncio.current_task():
+            del manager.relays[job_id]
+
+async def flush_training_updates(job_id: str, lines: Iterable[str], progress: Optional[float]):
+    """Write buffered log lines and the latest progress to Redis"""
+    job_fields = {'updated_at': time.time()}
+    if progress is not None:
+        job_fields['progress'] = progress
+    
+    await update_job(job_id, job_fields, lines)
+
 async def run_felafax_training(job_id: str, request: FineTuningRequest):
-    """Background task to run Felafax training"""
+    """Run Felafax training and stream its progress into Redis"""
+    process = None
     try:
-        # Update job status to running
-        job_data = redis_client.get(f"job:{job_id}")
-        if job_data:
-            job_dict = json.loads(job_data)
-            job_dict['status'] = 'running'
-            job_dict['updated_at'] = datetime.now().isoformat()
-            redis_client.set(f"job:{job_id}", json.dumps(job_dict))
+        # Update job status to running, unless it was cancelled while queued
+        if not await update_job_status(job_id, {
+            'status': 'running',
+            'updated_at': time.time()
+        }):
+            logger.info(f"Training job {job_id} was cancelled before it started")
+            return
         
         # Create config file
         config_path = f"/tmp/{job_id}_config.yml"
         with open(config_path, 'w') as f:
-            import yaml
-            yaml.dump(request.config, f)
+            yaml.dump(request.config, f, Dumper=YamlDumper)
         
         # Build felafax command
         cmd = [
@@ -373,67 +735,119 @@ async def run_felafax_training(job_id: str, request: FineTuningRequest):
         ]
         
         # Run the training process
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True,
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
             cwd='/home/z/my-project/felafax'
         )
         
-        # Monitor the process and update job status
-        logs = []
-        for line in iter(process.stdout.readline, ''):
-            if line:
-                logs.append(line.strip())
+        # Monitor the process and update job status in batches
+        # Lines beyond LOG_TAIL would be trimmed from Redis anyway, so never buffer more
+        pending_logs = deque(maxlen=LOG_TAIL)
+        progress = None
+        max_steps = request.config.get('num_steps', 1000)
+        flush_deadline = None
+        partial_line = b''
+        while True:
+            # Wait for more output only until buffered lines are due, so a trainer
+            # that goes quiet (eval, checkpointing) still gets its last lines flushed
+            timeout = None if flush_deadline is None else max(flush_deadline - time.monotonic(), 0)
+            try:
+                chunk = await asyncio.wait_for(process.stdout.read(TRAINER_READ_SIZE), timeout)
+            except asyncio.TimeoutError:
+                chunk = None
+            
+            if chunk is not None:
+                raw_lines = LINE_SPLIT_RE.split(partial_line + chunk)
+                # Carry an unterminated line over to the next read, unless output
+                # ended or the line is too long to keep buffering
+                partial_line = raw_lines.pop()
+                if not chunk or len(partial_line) >= TRAINER_LINE_LIMIT:
+                    raw_lines.append(partial_line)
+                    partial_line = b''
                 
-                # Update job with new logs
-                job_data = redis_client.get(f"job:{job_id}")
-                if job_data:
-                    job_dict = json.loads(job_data)
-                    job_dict['logs'] = logs[-100:]  # Keep last 100 lines
-                    job_dict['updated_at'] = datetime.now().isoformat()
+                for raw_line in raw_lines:
+                    if not raw_line.strip():
+                        continue
+                    if not pending_logs:
+                        flush_deadline = time.monotonic() + LOG_FLUSH_INTERVAL
+                    pending_logs.append(raw_line.decode(errors='replace').strip())
                     
                     # Parse progress from logs (simplified)
-                    if 'step' in line.lower() and 'loss' in line.lower():
-                        try:
-                            # Extract step number for progress calculation
-                            import re
-                            step_match = re.search(r'step\s*(\d+)', line.lower())
-                            if step_match:
+                    line_lower = raw_line.lower()
+                    if b'step' in line_lower and b'loss' in line_lower:
+                        # Extract step number for progress calculation
+                        step_match = STEP_RE.search(raw_line)
+                        if step_match:
+                            try:
                                 step = int(step_match.group(1))
-                                max_steps = request.config.get('num_steps', 1000)
                                 progress = min((step / max_steps) * 100, 100)
-                                job_dict['progress'] = progress
-                        except:
-                            pass
-                    
-                    redis_client.set(f"job:{job_id}", json.dumps(job_dict))
+                            except (TypeError, ZeroDivisionError):
+                                pass
+            
+            # Flush on timeout, at end of output, or once enough lines are buffered
+            if pending_logs and (not chunk
+                                 or len(pending_logs) >= LOG_FLUSH_LINES
+                                 or time.monotonic() >= flush_deadline):
+                await flush_training_updates(job_id, pending_logs, progress)
+                pending_logs.clear()
+                flush_deadline = None
+            
+            if chunk == b'':
+                break
         
         # Wait for process to complete
-        return_code = process.wait()
+        return_code = await process.wait()
         
-        # Update final job status
-        job_data = redis_client.get(f"job:{job_id}")
-        if job_data:
-            job_dict = json.loads(job_data)
-            job_dict['status'] = 'completed' if return_code == 0 else 'failed'
-            job_dict['progress'] = 100.0
-            job_dict['updated_at'] = datetime.now().isoformat()
-            redis_client.set(f"job:{job_id}", json.dumps(job_dict))
+        # Update final job status; a cancellation that raced the exit wins
+        await update_job_status(job_id, {
+            'status': 'completed' if return_code == 0 else 'failed',
+            'progress': 100.0,
+            'updated_at': time.time()
+        })
         
         logger.info(f"Training job {job_id} completed with return code {return_code}")
         
+    except asyncio.CancelledError:
+        # Aborted through arq (see cancel_job), or stopped by job_timeout / worker
+        # shutdown; don't leave the job 'running' unless cancel_job already marked it
+        await update_job_status(job_id, {
+            'status': 'failed',
+            'updated_at': time.time()
+        })
+        logger.info(f"Training job {job_id} aborted")
+        raise
+        
     except Exception as e:
         logger.error(f"Error in training job {job_id}: {str(e)}")
         
         # Update job status to failed
-        job_data = redis_client.get(f"job:{job_id}")
-        if job_data:
-            job_dict = json.loads(job_data)
-            job_dict['status'] = 'failed'
-            job_dict['updated_at'] = datetime.now().isoformat()
-            redis_client.set(f"job:{job_id}", json.dumps(job_dict))
+        await update_job_status(job_id, {
+            'status': 'failed',
+            'updated_at': time.time()
+        })
+        
+    finally:
+        # Never leave a trainer running unsupervised with nobody draining its stdout
+        if process and process.returncode is None:
+            process.terminate()
+            try:
+                await asyncio.wait_for(process.wait(), TRAINER_TERMINATE_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+
+async def run_felafax_training_task(ctx: Dict[str, Any], job_id: str, request_dict: Dict[str, Any]):
+    """arq task wrapper around run_felafax_training"""
+    await run_felafax_training(job_id, FineTuningRequest(**request_dict))
+
+class WorkerSettings:
+    """arq worker configuration, run with `arq main.WorkerSettings`"""
+    functions = [run_felafax_training_task]
+    redis_settings = arq_redis_settings
+    allow_abort_jobs = True
+    job_timeout = 24 * 60 * 60  # Training runs can take many hours
 
 if __name__ == "__main__":
     import uvicorn
@@ -15,6 +15,10 @@ fi
 echo "Installing Python dependencies..."
 pip install -r requirements.txt
 
+# Start the training worker
+echo "Starting training worker..."
+arq main.WorkerSettings &
+
 # Start the FastAPI service
 echo "Starting FastAPI service on port 8000..."
 python main.py
\ No newline at end of file